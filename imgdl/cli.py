@@ -35,10 +35,13 @@ def parse(args=None):
                         help="Timeout to be given to the url request")
 
     parser.add_argument('--min_wait', type=float, default=config['MIN_WAIT'],
-                        help="Minimum wait time between image downloads")
+                        help="Minimum wait time between image downloads through the same proxy")
 
     parser.add_argument('--max_wait', type=float, default=config['MAX_WAIT'],
-                        help="Maximum wait time between image downloads")
+                        help="Maximum wait time between image downloads through the same proxy")
+
+    parser.add_argument('--max_rps', type=float, default=config['MAX_RPS'],
+                        help="Maximum number of requests per second over all threads and proxies")
 
     parser.add_argument('--proxy', type=str, action='append', default=config['PROXIES'],
                         help="Proxy or list of proxies to use for the requests")
@@ -46,6 +49,9 @@ def parse(args=None):
     parser.add_argument('-u', '--user_agent', type=str, default=config['USER_AGENT'],
                         help="User agent to be used for the requests")
 
+    parser.add_argument('--hash_algo', type=str, default=config['HASH_ALGO'], choices=['sha1', 'xxh128'],
+                        help="Hash used to name the stored images after their url")
+
     parser.add_argument('-f', '--force', action='store_true',
                         help="Force the download even if the files already exists")
 
@@ -75,4 +81,6 @@ def main(args=None):
         notebook=args.notebook,
         debug=args.debug,
         force=args.force,
+        hash_algo=args.hash_algo,
+        max_rps=args.max_rps,
     )
@@ -3,9 +3,11 @@
 
 # edited by uma
 
-import collections
+import collections.abc
 import hashlib
+import itertools
 import logging
+import os
 import random
 from concurrent import futures
 from io import BytesIO
@@ -17,13 +19,80 @@ from uuid import uuid4
 import attr
 import requests
 from PIL import Image
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm, tqdm_notebook
 
 from .settings import config, get_logger
-from .utils import to_bytes
+from .utils import Throttle, TokenBucket, to_bytes
 
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 
-def make_session(proxies=None, headers=None):
+CHUNK_SIZE = 64 * 1024
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+STATUS_RETRIES = 5
+# Few retries on connection errors: a host that cannot be reached is
+# unlikely to come back within the backoff
+ERROR_RETRIES = 2
+BACKOFF_FACTOR = 0.5
+PROXY_ATTEMPTS = 3
+
+
+def _sha1_hexdigest(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+HASH_FUNCTIONS = {'sha1': _sha1_hexdigest}
+if xxhash is not None:
+    HASH_FUNCTIONS['xxh128'] = xxhash.xxh3_128_hexdigest
+
+
+def _to_rgb(img, size=None):
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    elif size:
+        img = img.copy()
+    if size:
+        img.thumbnail(size, Image.LANCZOS)
+    return img
+
+
+def _composite_on_white(img, size=None):
+    img = img.convert('RGBA')
+    if size:
+        # Resize before compositing so that only the thumbnail pixels
+        # are blended
+        img.thumbnail(size, Image.LANCZOS)
+    background = Image.new('RGBA', img.size, (255, 255, 255))
+    background.paste(img, img)
+    return background.convert('RGB')
+
+
+# Conversions to RGB keyed by (format, mode). A format of None matches any
+# format. Other images are converted with _to_rgb
+_RGB_CONVERTERS = {
+    ('PNG', 'RGBA'): _composite_on_white,
+    (None, 'P'): _composite_on_white,
+}
+
+
+def _retry_delay(n_retries, response=None):
+    """Seconds to wait before retry number ``n_retries``, honoring Retry-After"""
+    retry_after = response.headers.get('Retry-After', '') if response is not None else ''
+    if retry_after.isdigit():
+        return float(retry_after)
+    return BACKOFF_FACTOR * 2 ** (n_retries - 1)
+
+
+def make_session(proxies=None, headers=None, pool_size=None):
+    """Create a requests session.
+
+    If ``pool_size`` is given, the session keeps up to that many keep-alive
+    connections per host so that TCP/TLS connections are reused across
+    downloads.
+    """
     proxies = proxies or {}
     headers = headers or {}
     s = requests.Session()
@@ -31,6 +100,11 @@ def make_session(proxies=None, headers=None):
     s.headers.update(headers)
     s.id = uuid4().hex
 
+    if pool_size is not None:
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        s.mount('http://', adapter)
+        s.mount('https://', adapter)
+
     return s
 
 
@@ -49,9 +123,10 @@ class ImageDownloader(object):
     timeout : float
         Timeout to be given to the url request
     min_wait : float
-        Minimum wait time between image downloads
+        Minimum wait time between image downloads through the same proxy
     max_wait : float
-        Maximum wait time between image downloads
+        Maximum wait time between image downloads through the same proxy.
+        Without proxies, the wait spaces the downloads of all threads together
     proxies : str | list
         Proxy or list of proxies to use for the requests
     headers : dict
@@ -64,6 +139,12 @@ class ImageDownloader(object):
         If True, log urls that could not be downloaded
     logfile : str
         Path to logfile
+    hash_algo : str
+        Hash used to name the stored images after their url. 'sha1' or,
+        if the xxhash package is installed, the much faster 'xxh128'
+    max_rps : float
+        Maximum number of requests per second over all threads and proxies.
+        No limit if None
     """
 
     store_path = attr.ib(converter=lambda v: Path(v).expanduser(), default=config['STORE_PATH'])
@@ -77,6 +158,8 @@ class ImageDownloader(object):
     notebook = attr.ib(converter=bool, default=False)
     debug = attr.ib(converter=bool, default=False)
     logfile = attr.ib(default=config.get('LOGFILE'))
+    hash_algo = attr.ib(converter=str, default=config['HASH_ALGO'])
+    max_rps = attr.ib(converter=attr.converters.optional(float), default=config['MAX_RPS'])
 
     @user_agent.validator
     def update_headers(self, attribute, value):
@@ -114,6 +197,31 @@ class ImageDownloader(object):
         if (self.logfile is None) and (not value):
             logging.disable(logging.CRITICAL)
 
+    @hash_algo.validator
+    def check_hash_algo(self, attribute, value):
+        if value not in HASH_FUNCTIONS:
+            raise ValueError(f"hash_algo should be one of {sorted(HASH_FUNCTIONS)}, got '{value}'. "
+                             f"'xxh128' requires the xxhash package")
+
+    @max_rps.validator
+    def check_max_rps(self, attribute, value):
+        if value is not None and value <= 0:
+            raise ValueError(f"max_rps should be positive or None, got {value}")
+
+    def __attrs_post_init__(self):
+        # Shared by all worker threads so keep-alive connections are reused
+        # across urls. Proxies are given per request.
+        self._session = make_session(pool_size=self.n_workers)
+        self._throttle = Throttle()
+        self._rate_limit = TokenBucket(self.max_rps) if self.max_rps is not None else None
+        # Image paths are built by string concatenation, cheaper than Path.
+        # The prefix is cached along with the store_path it was built from
+        self._store_dir = (None, None)
+        # Round robin over shuffled proxies spreads the load evenly
+        self._proxy_cycle = None
+        if self.proxies is not None:
+            self._proxy_cycle = itertools.cycle(random.sample(self.proxies, len(self.proxies)))
+
     def __call__(self, urls, force=False):
         """Download url or list of urls
 
@@ -139,33 +247,93 @@ class ImageDownloader(object):
             separation = '=' * max(map(len, arguments.split("\n")))
             print(f"{separation}\n{title}\n{arguments}\n{separation}")
 
-        if not isinstance(urls, (str, collections.Iterable)):
+        if not isinstance(urls, (str, collections.abc.Iterable)):
             raise ValueError("urls should be str or iterable")
 
         if isinstance(urls, str):
-            return str(self._download_image(urls, force=force))
-
-        with futures.ThreadPoolExecutor(max_workers=self.n_workers) as executor:
-            n_fail = 0
-            future_to_url = {
-                executor.submit(self._download_image, url, force): (i, url)
-                for i, url in enumerate(urls)
-            }
-            total = len(future_to_url)
-            paths = [None] * total
-            for future in self.tqdm(futures.as_completed(future_to_url), total=total, miniters=1):
-                i, url = future_to_url[future]
-                if future.exception() is None:
-                    #print('qwe')
-                    paths[i] = (url, str(future.result()))
-                else:
+            return self._download_image(urls, force=force)
+
+        # One directory listing instead of a stat() per url
+        cached = set() if force else {entry.name for entry in os.scandir(self.store_path)}
+
+        total = len(urls) if isinstance(urls, collections.abc.Sized) else None
+        max_in_flight = 2 * self.n_workers
+        n_fail = 0
+        paths = []
+        future_to_url = {}
+
+        with futures.ThreadPoolExecutor(max_workers=self.n_workers) as executor, \
+                self.tqdm(total=total, miniters=1) as progress:
+            for i, url in enumerate(urls):
+                try:
+                    image_guid = self.image_guid(url)
+                except Exception as e:
+                    # Invalid entries (e.g. None or NaN) must not stop the batch
+                    self.logger.error('Failed', extra={
+                        'success': False,
+                        'url': url,
+                        'Exception': {'type': type(e), 'msg': str(e)},
+                    })
                     n_fail += 1
+                    paths.append(None)
+                    progress.update()
+                    continue
+
+                if image_guid in cached:
+                    path = self.file_path(image_guid)
+                    self.logger.info('On cache', extra={'success': True, 'url': url, 'filepath': path})
+                    paths.append((url, path))
+                    progress.update()
+                    continue
+
+                future = executor.submit(self._download_image, url, force, image_guid=image_guid,
+                                         checked=True)
+                future_to_url[future] = (i, url)
+                paths.append(None)
+
+                # Consume urls lazily so that memory does not grow with their number
+                if len(future_to_url) >= max_in_flight:
+                    done, _ = futures.wait(future_to_url, return_when=futures.FIRST_COMPLETED)
+                    n_fail += self._collect(done, future_to_url, paths, progress)
 
-            self.logger.warning(f"{n_fail} images failed to download")
+            n_fail += self._collect(futures.as_completed(list(future_to_url)), future_to_url, paths, progress)
+
+        self.logger.warning(f"{n_fail} images failed to download")
 
         return paths
 
-    def _download_image(self, url, force=False, session=None, timeout=None, min_size=10000):
+    def get_proxy(self):
+        """Return the proxy for the next request, or None if there are no proxies"""
+        if self._proxy_cycle is None:
+            return None
+        return next(self._proxy_cycle)
+
+    @staticmethod
+    def _collect(done, future_to_url, paths, progress):
+        """Store the results of finished futures and return the number of failures"""
+        n_fail = 0
+        for future in done:
+            i, url = future_to_url.pop(future)
+            if future.exception() is None:
+                paths[i] = (url, future.result())
+            else:
+                n_fail += 1
+            progress.update()
+        return n_fail
+
+    def image_guid(self, url):
+        """Return the hash of ``url`` under which its image is stored"""
+        return HASH_FUNCTIONS[self.hash_algo](to_bytes(url))
+
+    def file_path(self, image_guid):
+        """Return the path of the image stored under ``image_guid``"""
+        store_path, store_dir = self._store_dir
+        if store_path is not self.store_path:
+            store_path, store_dir = self._store_dir = (self.store_path, str(self.store_path) + os.sep)
+        return store_dir + image_guid
+
+    def _download_image(self, url, force=False, session=None, timeout=None, min_size=10000,
+                        image_guid=None, checked=False):
         """Download image and convert to jpeg rgb mode.
 
         If the image path already exists, it considers that the file has
@@ -182,11 +350,19 @@ class ImageDownloader(object):
 
         session : requests.Session
             An instance of requests.Session with which image will be downloaded.
-            Useful when you want to use the same session for several downloads.
+            Defaults to the pooled session shared by all downloads.
 
         timeout : float
             Timeout to be given to the url request
 
+        image_guid : str
+            Hash of the url as returned by ``image_guid``. Computed from the
+            url if not given.
+
+        checked : bool
+            If True the caller already checked that the image is not stored,
+            so the path is not looked up again
+
         Returns
         -------
         path : str
@@ -196,8 +372,8 @@ class ImageDownloader(object):
             'success': False,
             'url': url,
         }
-        path = Path(self.store_path, hashlib.sha1(to_bytes(url)).hexdigest())
-        if path.exists() and not force:
+        path = self.file_path(image_guid or self.image_guid(url))
+        if not (force or checked) and os.path.exists(path):
             metadata.update({
                 'success': True,
                 'filepath': path
@@ -205,38 +381,44 @@ class ImageDownloader(object):
             self.logger.info('On cache', extra=metadata)
             return path
         try:
-            session = session or make_session(proxies=random.choice(self.proxies), headers=self.headers)
+            # Own session: headers are given per request so that changes
+            # to self.headers are taken into account
+            headers = None
+            if session is None:
+                session, headers = self._session, self.headers
             timeout = timeout or self.timeout
             metadata['session'] = {
-                'headers': dict(session.headers),
-                'id': session.id,
+                'headers': dict(headers or session.headers),
+                'id': getattr(session, 'id', None),
                 'proxy': session.proxies.get('http'),
                 'timeout': timeout,
             }
-            
-            response = session.get(url, timeout=timeout)
-            metadata['response'] = {
-                'headers': dict(response.headers),
-                'status_code': response.status_code,
-            }
 
-            if response.status_code != 200:
-                raise Exception("Status code "+str(response.status_code))
-                
-            if len(response.content) < min_size:
-                raise Exception("Length too small")
-
-            # orig_img = Image.open(BytesIO(response.content))
-            # img, buf = self.convert_image(orig_img)
-            with path.open('wb') as f:
-                f.write(response.content)
+            with self._get(url, session, timeout, metadata, headers) as response:
+                metadata['response'] = {
+                    'headers': dict(response.headers),
+                    'status_code': response.status_code,
+                }
+
+                if response.status_code != 200:
+                    raise Exception("Status code "+str(response.status_code))
+
+                # Content-Length gives the encoded size, only comparable with
+                # min_size when the body is not compressed
+                content_length = response.headers.get('Content-Length', '')
+                if ('Content-Encoding' not in response.headers and content_length.isdigit()
+                        and int(content_length) < min_size):
+                    raise Exception("Length too small")
+
+                # orig_img = Image.open(BytesIO(response.content))
+                # img, buf = self.convert_image(orig_img)
+                self._save_response(response, path, min_size)
             metadata.update({
                 'success': True,
                 'filepath': path,
             })
 
             self.logger.info('Downloaded', extra=metadata)
-            sleep(random.uniform(self.min_wait, self.max_wait))
         except Exception as e:
             metadata['Exception'] = {
                 'type': type(e),
@@ -246,15 +428,94 @@ class ImageDownloader(object):
             raise e
         return path
 
+    def _get(self, url, session, timeout, metadata, headers=None):
+        """Request ``url``, retrying transient failures.
+
+        Every attempt, retries included, goes through the per-proxy throttle
+        and the global rate limit. Proxy errors switch to the next proxy.
+        Connection errors and responses with a status in RETRY_STATUSES are
+        retried with an exponential backoff, honoring Retry-After headers.
+        Once retries are exhausted the last response is returned.
+        """
+        n_proxy_errors = n_errors = n_status_retries = 0
+        while True:
+            proxy = self.get_proxy()
+            if proxy is not None:
+                metadata['session']['proxy'] = proxy['http']
+
+            if self.max_wait > 0:
+                # Downloads through the same proxy are spaced by a random wait,
+                # different proxies don't wait for each other.
+                self._throttle.wait(proxy and proxy['http'], random.uniform(self.min_wait, self.max_wait))
+
+            if self._rate_limit is not None:
+                self._rate_limit.acquire()
+
+            try:
+                response = session.get(url, timeout=timeout, proxies=proxy, headers=headers, stream=True)
+            except requests.exceptions.ProxyError:
+                n_proxy_errors += 1
+                if proxy is None or n_proxy_errors >= PROXY_ATTEMPTS:
+                    raise
+                self.logger.info('Proxy failed', extra=metadata)
+                continue
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                n_errors += 1
+                if n_errors > ERROR_RETRIES:
+                    raise
+                delay = _retry_delay(n_errors)
+            else:
+                if response.status_code not in RETRY_STATUSES or n_status_retries >= STATUS_RETRIES:
+                    return response
+                n_status_retries += 1
+                delay = _retry_delay(n_status_retries, response)
+                response.close()
+
+            self.logger.info('Retrying', extra=metadata)
+            sleep(delay)
+
     @staticmethod
-    def convert_image(img, size=None):
+    def _save_response(response, path, min_size=0):
+        """Stream the body of ``response`` to ``path``.
+
+        The body is written chunk by chunk to a temporary file next to
+        ``path``, which is renamed to ``path`` once complete. Bodies shorter
+        than ``min_size`` bytes are discarded.
+        """
+        part_path = f'{path}.{uuid4().hex}.part'
+        try:
+            size = 0
+            with open(part_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    f.write(chunk)
+                    size += len(chunk)
+
+            if size < min_size:
+                raise Exception("Length too small")
+
+            os.replace(part_path, path)
+        finally:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+
+    @staticmethod
+    def convert_image(img, size=None, data=None):
         """Convert images to JPG, RGB mode and given size if any.
 
+        If ``size`` and ``data`` are given, JPEG images are decoded again
+        from ``data`` directly at a reduced scale (shrink-on-load). ``img``
+        itself is never modified.
+
         Parameters
         ----------
         img : Pil.Image
         size : tuple
             tuple of (width, height)
+        data : bytes
+            Encoded bytes from which ``img`` was opened. If given and ``img``
+            is already a RGB JPEG that needs no resizing, they are returned
+            as is instead of re-encoding the image. If given with ``size``,
+            they are used to decode JPEG images at a reduced scale.
 
         Returns
         -------
@@ -263,21 +524,17 @@ class ImageDownloader(object):
         buf : BytesIO
             Buffer of the converted image
         """
-        if img.format == 'PNG' and img.mode == 'RGBA':
-            background = Image.new('RGBA', img.size, (255, 255, 255))
-            background.paste(img, img)
-            img = background.convert('RGB')
-        elif img.mode == 'P':
-            img = img.convert("RGBA")
-            background = Image.new('RGBA', img.size, (255, 255, 255))
-            background.paste(img, img)
-            img = background.convert('RGB')
-        elif img.mode != 'RGB':
-            img = img.convert('RGB')
-
-        if size:
-            img = img.copy()
-            img.thumbnail(size, Image.ANTIALIAS)
+        if data is not None and not size and img.format == 'JPEG' and img.mode == 'RGB':
+            return img, BytesIO(data)
+
+        if size and data is not None and img.format == 'JPEG':
+            # Let libjpeg decode at 1/2, 1/4 or 1/8 scale when that is still
+            # larger than size. Done on a fresh image to leave img intact.
+            img = Image.open(BytesIO(data))
+            img.draft('RGB', size)
+
+        convert = _RGB_CONVERTERS.get((img.format, img.mode)) or _RGB_CONVERTERS.get((None, img.mode), _to_rgb)
+        img = convert(img, size)
 
         buf = BytesIO()
         img.save(buf, 'JPEG')
@@ -296,7 +553,9 @@ def download(urls,
              notebook=False,
              debug=False,
              force=False,
-             logfile=config.get('LOGFILE')):
+             logfile=config.get('LOGFILE'),
+             hash_algo=config['HASH_ALGO'],
+             max_rps=config['MAX_RPS']):
     """Asynchronously download images using multiple threads.
 
     Parameters
@@ -310,9 +569,10 @@ def download(urls,
     timeout : float
         Timeout to be given to the url request
     min_wait : float
-        Minimum wait time between image downloads
+        Minimum wait time between image downloads through the same proxy
     max_wait : float
-        Maximum wait time between image downloads
+        Maximum wait time between image downloads through the same proxy.
+        Without proxies, the wait spaces the downloads of all threads together
     proxies : list | dict
         Proxy or list of proxies to use for the requests
     headers : dict
@@ -327,6 +587,11 @@ def download(urls,
         If True force the download even if the files already exists
     logfile : str
         Path to logfile
+    hash_algo : str
+        Hash used to name the stored images after their url ('sha1' or 'xxh128')
+    max_rps : float
+        Maximum number of requests per second over all threads and proxies.
+        No limit if None
 
     Returns
     -------
@@ -347,6 +612,8 @@ def download(urls,
         notebook=notebook,
         debug=debug,
         logfile=logfile,
+        hash_algo=hash_algo,
+        max_rps=max_rps,
     )
 
     return downloader(urls, force=force)
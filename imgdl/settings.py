@@ -18,6 +18,8 @@ config = {
     'MIN_WAIT': 0.0,
     'MAX_WAIT': 0.0,
     'PROXIES': None,
+    'HASH_ALGO': 'sha1',
+    'MAX_RPS': None,
     'USER_AGENT': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:55.0) Gecko/20100101 Firefox/55.0',
     'HEADERS': requests.utils.default_headers()
 }
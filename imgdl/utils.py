@@ -2,6 +2,8 @@
 # -*- coding: utf-8 -*-
 
 import hashlib
+import threading
+from time import monotonic, sleep
 
 
 def md5sum(fname):
@@ -25,4 +27,51 @@ def to_bytes(text, encoding=None, errors='strict'):
                         'object, got %s' % type(text).__name__)
     if encoding is None:
         encoding = 'utf-8'
-    return text.encode(encoding, errors)
\ No newline at end of file
+    return text.encode(encoding, errors)
+
+
+class Throttle(object):
+    """Space out events that share the same key.
+
+    ``wait(key, delay)`` blocks until the time slot reserved for ``key``
+    and reserves the next one ``delay`` seconds later. Events with
+    different keys never wait for each other. Thread safe.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._next_slot = {}
+
+    def wait(self, key, delay):
+        with self._lock:
+            now = monotonic()
+            slot = max(now, self._next_slot.get(key, now))
+            self._next_slot[key] = slot + delay
+        if slot > now:
+            sleep(slot - now)
+
+
+class TokenBucket(object):
+    """Limit events to ``rate`` per second, allowing bursts of ``capacity``.
+
+    ``acquire()`` takes tokens from the bucket, blocking until they have
+    been refilled. Thread safe.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._tokens = self.capacity
+        self._last = monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        with self._lock:
+            now = monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            # Tokens may go negative: callers queue up for future refills
+            self._tokens -= tokens
+            wait = -self._tokens / self.rate
+        if wait > 0:
+            sleep(wait)
@@ -1,11 +1,17 @@
 # -*- coding: utf-8 -*-
 
+import hashlib
+import os
+from io import BytesIO
 from pathlib import Path
 from tempfile import TemporaryDirectory
+from time import monotonic
 
 import pytest
+import requests
+from PIL import Image
 
-from imgdl.downloader import ImageDownloader
+from imgdl.downloader import PROXY_ATTEMPTS, STATUS_RETRIES, ImageDownloader
 
 
 def test_headers_init():
@@ -42,3 +48,291 @@ def test_make_dirs():
         "store_path should have been created"
 
     store_path.cleanup()
+
+
+def _jpeg_bytes(size):
+    buf = BytesIO()
+    Image.new('RGB', size, (10, 200, 30)).save(buf, 'JPEG')
+    return buf.getvalue()
+
+
+def test_convert_image_thumbnail():
+
+    img, _ = ImageDownloader.convert_image(Image.open(BytesIO(_jpeg_bytes((1600, 1200)))), size=(200, 200))
+    assert img.size == (200, 150), "Thumbnail should keep the aspect ratio"
+    assert img.mode == 'RGB'
+
+
+def test_convert_image_keeps_input_image():
+
+    data = _jpeg_bytes((1600, 1200))
+    orig_img = Image.open(BytesIO(data))
+    _ = ImageDownloader.convert_image(orig_img, size=(200, 200), data=data)
+    assert orig_img.size == (1600, 1200), "Input image should not be modified"
+    img, _ = ImageDownloader.convert_image(orig_img)
+    assert img.size == (1600, 1200)
+
+
+def test_convert_image_shrink_on_load(monkeypatch):
+
+    data = _jpeg_bytes((1600, 1200))
+    decoded_sizes = []
+    thumbnail = Image.Image.thumbnail
+
+    def spy_thumbnail(self, *args, **kwargs):
+        decoded_sizes.append(self.size)
+        return thumbnail(self, *args, **kwargs)
+
+    monkeypatch.setattr(Image.Image, 'thumbnail', spy_thumbnail)
+    img, _ = ImageDownloader.convert_image(Image.open(BytesIO(data)), size=(200, 200), data=data)
+    assert img.size == (200, 150)
+    assert decoded_sizes == [(400, 300)], "JPEG should be decoded at 1/4 scale"
+
+
+def test_convert_image_transparent_thumbnail():
+
+    buf = BytesIO()
+    Image.new('RGBA', (400, 400), (200, 0, 0, 0)).save(buf, 'PNG')
+    img, _ = ImageDownloader.convert_image(Image.open(buf), size=(100, 100))
+    assert img.size == (100, 100)
+    assert img.getpixel((50, 50)) == (255, 255, 255), \
+        "Transparent pixels should be composited onto a white background"
+
+
+def test_hash_algo():
+
+    url = "https://upload.wikimedia.org/wikipedia/commons/9/92/Moh_%283%29.jpg"
+    assert ImageDownloader().image_guid(url) == hashlib.sha1(url.encode()).hexdigest(), \
+        "Images should be named after the sha1 of their url by default"
+
+    with pytest.raises(ValueError):
+        ImageDownloader(hash_algo='md4')
+
+
+def test_hash_algo_xxh128():
+
+    xxhash = pytest.importorskip('xxhash')
+    url = "https://upload.wikimedia.org/wikipedia/commons/9/92/Moh_%283%29.jpg"
+    assert ImageDownloader(hash_algo='xxh128').image_guid(url) == xxhash.xxh3_128_hexdigest(url.encode())
+
+    downloader = ImageDownloader()
+    downloader.hash_algo = 'xxh128'
+    assert downloader.image_guid(url) == xxhash.xxh3_128_hexdigest(url.encode()), \
+        "image_guid should use the current hash_algo"
+
+
+def test_convert_image_keeps_jpeg_bytes():
+
+    data = _jpeg_bytes((100, 100))
+    _, out = ImageDownloader.convert_image(Image.open(BytesIO(data)), data=data)
+    assert out.getvalue() == data, "RGB JPEG images should not be re-encoded"
+
+
+def test_get_proxy():
+
+    proxies = [f"http://proxy.provider.com:{port}" for port in range(4015, 4019)]
+    downloader = ImageDownloader(proxies=proxies)
+    used = [downloader.get_proxy()['http'] for _ in range(2 * len(proxies))]
+    assert sorted(used) == sorted(proxies * 2), "Proxies should be used in turns"
+
+    assert ImageDownloader(proxies=None).get_proxy() is None
+
+
+class StubResponse(object):
+
+    def __init__(self, body, headers=None, status_code=200, fail_after=None):
+        self.body = body
+        self.headers = headers if headers is not None else {'Content-Length': str(len(body))}
+        self.status_code = status_code
+        self.fail_after = fail_after
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def close(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        for n, start in enumerate(range(0, len(self.body), chunk_size)):
+            if n == self.fail_after:
+                raise IOError("Connection lost")
+            yield self.body[start:start + chunk_size]
+
+
+class StubSession(object):
+
+    def __init__(self, response, exception=None):
+        self.response = response
+        self.exception = exception
+        self.headers = {}
+        self.proxies = {}
+        self.calls = []
+        self.headers_sent = []
+        self.times = []
+
+    def get(self, url, proxies=None, headers=None, **kwargs):
+        self.times.append(monotonic())
+        self.calls.append(proxies)
+        self.headers_sent.append(headers)
+        if self.exception is not None:
+            raise self.exception
+        return self.response
+
+
+def test_download_image_writes_file():
+
+    with TemporaryDirectory() as store_path:
+        downloader = ImageDownloader(store_path=store_path)
+        url = 'http://images.example.com/a.jpg'
+        body = b'x' * 100000
+        path = downloader._download_image(url, session=StubSession(StubResponse(body)))
+        assert path == downloader.file_path(downloader.image_guid(url))
+        assert Path(path).read_bytes() == body
+        assert os.listdir(store_path) == [downloader.image_guid(url)], "No temporary file should be left"
+
+
+def test_download_image_rejects_short_body():
+
+    with TemporaryDirectory() as store_path:
+        downloader = ImageDownloader(store_path=store_path)
+        for headers in ({'Content-Length': '10'}, {}):
+            session = StubSession(StubResponse(b'x' * 10, headers=headers))
+            with pytest.raises(Exception, match="Length too small"):
+                downloader._download_image('http://images.example.com/a.jpg', session=session)
+        assert os.listdir(store_path) == [], "Short bodies should not be stored"
+
+
+def test_download_image_compressed_body():
+
+    with TemporaryDirectory() as store_path:
+        downloader = ImageDownloader(store_path=store_path)
+        headers = {'Content-Length': '10', 'Content-Encoding': 'gzip'}
+        session = StubSession(StubResponse(b'x' * 100000, headers=headers))
+        path = downloader._download_image('http://images.example.com/a.jpg', session=session)
+        assert Path(path).stat().st_size == 100000, \
+            "Compressed Content-Length should not be compared with min_size"
+
+
+def test_download_image_failure_leaves_no_file():
+
+    with TemporaryDirectory() as store_path:
+        downloader = ImageDownloader(store_path=store_path)
+        session = StubSession(StubResponse(b'x' * 1000000, fail_after=2))
+        with pytest.raises(IOError):
+            downloader._download_image('http://images.example.com/a.jpg', session=session)
+        assert os.listdir(store_path) == [], "Interrupted downloads should leave no .part file"
+
+
+def test_invalid_url_in_iterable_returns_none():
+
+    with TemporaryDirectory() as store_path:
+        downloader = ImageDownloader(store_path=store_path)
+        downloader._session = StubSession(StubResponse(b'x' * 100000))
+        url = 'http://images.example.com/a.jpg'
+        paths = downloader([url, float('nan'), None])
+        assert paths == [(url, downloader.file_path(downloader.image_guid(url))), None, None], \
+            "Invalid urls should give None without stopping the batch"
+
+
+def test_proxy_error_switches_proxy():
+
+    proxies = [f"http://proxy.provider.com:{port}" for port in range(4015, 4019)]
+    with TemporaryDirectory() as store_path:
+        downloader = ImageDownloader(store_path=store_path, proxies=proxies)
+        downloader._session = StubSession(None, exception=requests.exceptions.ProxyError())
+        with pytest.raises(requests.exceptions.ProxyError):
+            downloader._download_image('http://images.example.com/a.jpg')
+        used = [proxy['http'] for proxy in downloader._session.calls]
+        assert len(used) == PROXY_ATTEMPTS, "Each attempt should make one request"
+        assert len(set(used)) == PROXY_ATTEMPTS, "Each attempt should use a different proxy"
+
+        downloader = ImageDownloader(store_path=store_path, proxies=None)
+        downloader._session = StubSession(None, exception=requests.exceptions.ProxyError())
+        with pytest.raises(requests.exceptions.ProxyError):
+            downloader._download_image('http://images.example.com/a.jpg')
+        assert downloader._session.calls == [None], "Without proxies there is nothing to switch to"
+
+
+def test_file_path_follows_store_path():
+
+    with TemporaryDirectory() as first, TemporaryDirectory() as second:
+        downloader = ImageDownloader(store_path=first)
+        assert downloader.file_path('guid') == str(Path(first, 'guid'))
+        downloader.store_path = Path(second)
+        assert downloader.file_path('guid') == str(Path(second, 'guid')), \
+            "file_path should use the current store_path"
+
+
+def test_headers_changes_are_used():
+
+    with TemporaryDirectory() as store_path:
+        downloader = ImageDownloader(store_path=store_path)
+        downloader._session = StubSession(StubResponse(b'x' * 100000))
+        downloader.headers['User-Agent'] = "robot"
+        downloader._download_image('http://images.example.com/a.jpg')
+        assert downloader._session.headers_sent[-1]['User-Agent'] == "robot", \
+            "Requests should use the current headers"
+
+
+def test_call_skips_cached_images():
+
+    with TemporaryDirectory() as store_path:
+        downloader = ImageDownloader(store_path=store_path)
+        downloader._session = StubSession(StubResponse(b'x' * 100000))
+        url = 'http://images.example.com/a.jpg'
+        path = downloader.file_path(downloader.image_guid(url))
+        Path(path).write_bytes(b'cached')
+
+        assert downloader([url]) == [(url, path)]
+        assert downloader._session.calls == [], "Cached images should not be requested"
+
+        assert downloader([url], force=True) == [(url, path)]
+        assert len(downloader._session.calls) == 1, "force should request cached images"
+        assert Path(path).read_bytes() == b'x' * 100000
+
+
+def test_call_consumes_urls_lazily():
+
+    n_workers = 2
+    with TemporaryDirectory() as store_path:
+        downloader = ImageDownloader(store_path=store_path, n_workers=n_workers)
+        downloader._session = StubSession(StubResponse(b'x' * 100000))
+        completed = []
+        download_image = downloader._download_image
+
+        def counting_download_image(*args, **kwargs):
+            path = download_image(*args, **kwargs)
+            completed.append(path)
+            return path
+
+        downloader._download_image = counting_download_image
+        urls = [f'http://images.example.com/{i}.jpg' for i in range(20)]
+        max_ahead = []
+
+        def iterator():
+            for n, url in enumerate(urls, 1):
+                max_ahead.append(n - len(completed))
+                yield url
+
+        paths = downloader(iterator())
+        assert max(max_ahead) <= 2 * n_workers, "urls should not be read far ahead of downloads"
+        assert [url for url, _ in paths] == urls, "paths should keep the order of urls"
+
+
+def test_max_rps_applies_to_retries():
+
+    max_rps = 20
+    with TemporaryDirectory() as store_path:
+        downloader = ImageDownloader(store_path=store_path, max_rps=max_rps)
+        response = StubResponse(b'', headers={'Retry-After': '0'}, status_code=429)
+        downloader._session = StubSession(response)
+        with pytest.raises(Exception, match="Status code 429"):
+            downloader._download_image('http://images.example.com/a.jpg')
+
+        times = downloader._session.times
+        assert len(times) == 1 + STATUS_RETRIES, "Throttled responses should be retried"
+        gaps = [later - earlier for earlier, later in zip(times, times[1:])]
+        assert min(gaps) >= 0.9 / max_rps, "Retries should respect max_rps"
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+
+from time import monotonic
+
+from imgdl.utils import Throttle, TokenBucket
+
+
+def test_throttle_spaces_same_key():
+
+    throttle = Throttle()
+    start = monotonic()
+    for _ in range(3):
+        throttle.wait('proxy', 0.05)
+    assert monotonic() - start >= 0.1, "Events with the same key should be spaced by delay"
+
+
+def test_throttle_independent_keys():
+
+    throttle = Throttle()
+    start = monotonic()
+    for key in range(3):
+        throttle.wait(key, 1)
+    assert monotonic() - start < 0.5, "Events with different keys should not wait for each other"
+
+
+def test_token_bucket_rate():
+
+    bucket = TokenBucket(rate=20)
+    start = monotonic()
+    for _ in range(5):
+        bucket.acquire()
+    assert monotonic() - start >= 0.2, "Acquiring beyond capacity should wait for refills"